@@ -1,140 +1,378 @@
 from __future__ import annotations
 
-import json
-import uuid
+import copy
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, Iterator
 
 from flask import (Flask, abort, flash, redirect, render_template, request,
                    url_for)
+from flask.json.provider import JSONProvider
 from markupsafe import Markup, escape
-from werkzeug.utils import secure_filename
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
+
+try:
+    import orjson
+
+    def dumps_bytes(obj: Any, *, indent: bool = False) -> bytes:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option)
+
+    loads = orjson.loads
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+    try:
+        import ujson as _json
+    except ImportError:
+        import json as _json  # type: ignore[no-redef]
+
+    def dumps_bytes(obj: Any, *, indent: bool = False) -> bytes:
+        if indent:
+            return _json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+        return _json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+    loads = _json.loads
+
+ATTRIBUTE_FIELDS = (
+    ("strength", "Fora"),
+    ("dexterity", "Destreza"),
+    ("constitution", "Constituio"),
+    ("intelligence", "Inteligncia"),
+    ("wisdom", "Sabedoria"),
+    ("charisma", "Carisma"),
+)
+
+ALLOWED_EXTENSIONS = frozenset({"png", "jpg", "jpeg", "gif", "webp"})
+
+# Single-line inputs are stripped; the free-text areas are kept verbatim.
+_STRIPPED_FIELDS = (
+    "name",
+    "race",
+    "character_class",
+    "background",
+    "level",
+    "hit_points",
+    "armor_class",
+    "speed",
+)
+_TEXT_FIELDS = ("proficiencies", "equipment", "spells", "notes")
+_ATTRIBUTE_FORM_KEYS = tuple((key, f"attr_{key}") for key, _ in ATTRIBUTE_FIELDS)
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+_BLANK_CHARACTER: Dict[str, Any] = {
+    "name": "",
+    "race": "",
+    "character_class": "",
+    "background": "",
+    "level": "1",
+    "hit_points": "",
+    "armor_class": "",
+    "speed": "",
+    "attributes": {key: 10 for key, _ in ATTRIBUTE_FIELDS},
+    "proficiencies": "",
+    "equipment": "",
+    "spells": "",
+    "notes": "",
+    "image": None,
+}
+
+# Fields shown on the character list; kept in the summary index file.
+_SUMMARY_FIELDS = ("name", "race", "character_class", "level", "image")
+
+_index_lock = threading.RLock()
+
+# mkstemp creates files as 0600; saved files get the usual umask-based mode instead.
+_umask = os.umask(0)
+os.umask(_umask)
+_NEW_FILE_MODE = 0o666 & ~_umask
+
+# Image files waiting to be removed by the background worker.
+_gc_q: queue.Queue[Path] = queue.Queue()
+_gc_thread: threading.Thread | None = None
+_gc_start_lock = threading.Lock()
+
+
+def _to_int(value: str | None) -> int:
+    if not value:
+        return 0
+    if value.isdecimal():
+        return int(value)
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def _summarize(character: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: character.get(key) for key in _SUMMARY_FIELDS}
+
+
+def _sort_index(index: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    return dict(sorted(index.items(), key=lambda item: (item[1].get("name") or "").lower()))
+
+
+def _gc_worker() -> None:
+    while True:
+        path = _gc_q.get()
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            pass
+        finally:
+            _gc_q.task_done()
+
+
+def _reset_gc_after_fork() -> None:
+    # A forked child (e.g. under a preloading server) inherits the queue, whose
+    # waiters include the parent's worker, but not the thread itself.
+    global _gc_q, _gc_thread, _gc_start_lock
+    _gc_q = queue.Queue()
+    _gc_thread = None
+    _gc_start_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_gc_after_fork)
+
+
+def _queue_unlink(path: Path) -> None:
+    # The worker is started on first use rather than at import.
+    global _gc_thread
+    with _gc_start_lock:
+        if _gc_thread is None or not _gc_thread.is_alive():
+            _gc_thread = threading.Thread(target=_gc_worker, name="image-gc", daemon=True)
+            _gc_thread.start()
+    _gc_q.put(path)
+
+
+class FastJSONProvider(JSONProvider):
+    """Flask JSON provider backed by orjson; only installed when orjson is available."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return dumps_bytes(obj).decode("utf-8")
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return loads(s)
 
 
 def create_app() -> Flask:
     app = Flask(__name__)
+    if orjson is not None:
+        # Without orjson, keep Flask's default provider, which also handles
+        # dates, decimals and the like that plain json/ujson reject.
+        app.json = FastJSONProvider(app)
     app.config["SECRET_KEY"] = "change-me"  # simple default for demo purposes
     app.config["UPLOAD_FOLDER"] = Path(app.root_path) / "static" / "uploads"
 
     data_dir = Path(app.root_path) / "data" / "characters"
     data_dir.mkdir(parents=True, exist_ok=True)
     app.config["DATA_DIR"] = data_dir
+    index_path = data_dir.parent / "index.json"
+    app.config["INDEX_PATH"] = index_path
+    index_lock_path = data_dir.parent / "index.lock"
     app.config["UPLOAD_FOLDER"].mkdir(parents=True, exist_ok=True)
 
-    ATTRIBUTE_FIELDS = [
-        ("strength", "Fora"),
-        ("dexterity", "Destreza"),
-        ("constitution", "Constituio"),
-        ("intelligence", "Inteligncia"),
-        ("wisdom", "Sabedoria"),
-        ("charisma", "Carisma"),
-    ]
-
-    ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "webp"}
+    # Parsed character files keyed by id, tagged with the (mtime, inode, size) of
+    # the file they were read from. Saves go through os.replace, which always
+    # creates a new inode, so coarse timestamps alone can't hide a change.
+    cache: Dict[str, tuple[tuple[int, int, int], Dict[str, Any]]] = {}
 
     @app.template_filter("nl2br")
     def nl2br_filter(value: str | None) -> Markup:
         if not value:
             return Markup("")
-        escaped_value = escape(value)
-        return Markup("<br>".join(escaped_value.splitlines()))
+        escaped_value = escape(value).replace("\r\n", "\n").replace("\r", "\n")
+        return escaped_value.replace("\n", Markup("<br>"))
+
+    def read_character_file(
+        path: str | Path, character_id: str, stat: os.stat_result
+    ) -> Dict[str, Any]:
+        version = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+        cached = cache.get(character_id)
+        if cached is not None and cached[0] == version:
+            data = cached[1]
+        else:
+            with open(path, "rb") as fp:
+                data = loads(fp.read())
+            cache[character_id] = (version, data)
+        # Copy the nested attributes too, so callers can't mutate the cached dict.
+        character = {**data, "attributes": dict(data.get("attributes") or {})}
+        character["id"] = character_id
+        return character
 
     def load_character(character_id: str) -> Dict[str, Any]:
         path = data_dir / f"{character_id}.json"
-        if not path.exists():
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
             abort(404, description="Personagem no encontrado")
-        with path.open("r", encoding="utf-8") as fp:
-            data = json.load(fp)
-        data["id"] = character_id
-        return data
+        return read_character_file(path, character_id, stat)
 
     def load_characters() -> list[Dict[str, Any]]:
         characters: list[Dict[str, Any]] = []
-        for file_path in data_dir.glob("*.json"):
-            with file_path.open("r", encoding="utf-8") as fp:
-                data = json.load(fp)
-            data["id"] = file_path.stem
-            characters.append(data)
-        return sorted(characters, key=lambda item: item.get("name", "").lower())
+        with os.scandir(data_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json") or not entry.is_file():
+                    continue
+                characters.append(read_character_file(entry.path, entry.name[:-5], entry.stat()))
+        return characters
+
+    def write_file_atomic(path: Path, payload: bytes) -> None:
+        # Write the whole payload to a uniquely named file next to the target,
+        # then swap it in so readers never see a half-written file. The buffered
+        # writer keeps writing until every byte is out or raises.
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+        try:
+            os.chmod(tmp_name, _NEW_FILE_MODE)
+            with open(fd, "wb") as fp:
+                fp.write(payload)
+            os.replace(tmp_name, path)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+
+    def save_character(character_id: str, character: Dict[str, Any]) -> None:
+        payload = dumps_bytes(character, indent=True)
+        write_file_atomic(data_dir / f"{character_id}.json", payload)
+
+    # The summary index records the data directory mtime it reflects. Creating,
+    # saving or deleting a character file changes that mtime, so an index that
+    # missed a change (a crash mid-save, files touched outside the app) is
+    # rebuilt on the next read. Writers hold locked_index() so concurrent
+    # threads and worker processes never apply an update to an outdated index.
+    @contextmanager
+    def locked_index() -> Iterator[None]:
+        with _index_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(index_lock_path, "ab") as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def data_dir_mtime_ns() -> int:
+        return os.stat(data_dir).st_mtime_ns
+
+    def read_index() -> Dict[str, Any] | None:
+        try:
+            with open(index_path, "rb") as fp:
+                return loads(fp.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write_index(characters: Dict[str, Dict[str, Any]], mtime_ns: int) -> None:
+        write_file_atomic(
+            index_path, dumps_bytes({"dir_mtime_ns": mtime_ns, "characters": characters})
+        )
 
-    def allowed_file(filename: str) -> bool:
-        return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+    def rebuild_index() -> Dict[str, Dict[str, Any]]:
+        # Stat before scanning so a change made during the scan leaves the index stale.
+        mtime_ns = data_dir_mtime_ns()
+        characters = _sort_index(
+            {character["id"]: _summarize(character) for character in load_characters()}
+        )
+        write_index(characters, mtime_ns)
+        return characters
+
+    def load_index() -> Dict[str, Dict[str, Any]]:
+        index = read_index()
+        if index is not None and index.get("dir_mtime_ns") == data_dir_mtime_ns():
+            return index["characters"]
+        with locked_index():
+            # Another writer may have rebuilt it while we waited for the lock.
+            index = read_index()
+            if index is not None and index.get("dir_mtime_ns") == data_dir_mtime_ns():
+                return index["characters"]
+            return rebuild_index()
+
+    def store_character(character_id: str, character: Dict[str, Any] | None) -> None:
+        """Save (or delete, when ``character`` is None) a character and update the index."""
+        with locked_index():
+            before_ns = data_dir_mtime_ns()
+            if character is None:
+                (data_dir / f"{character_id}.json").unlink(missing_ok=True)
+            else:
+                save_character(character_id, character)
+
+            index = read_index()
+            if index is None or index.get("dir_mtime_ns") != before_ns:
+                rebuild_index()
+                return
+            characters = index["characters"]
+            if character is None:
+                characters.pop(character_id, None)
+            else:
+                characters[character_id] = _summarize(character)
+                characters = _sort_index(characters)
+            write_index(characters, data_dir_mtime_ns())
+
+    def allowed_extension(filename: str) -> str | None:
+        _head, dot, extension = filename.rpartition(".")
+        extension = extension.lower()
+        return extension if dot and extension in ALLOWED_EXTENSIONS else None
 
     def handle_image_upload(character_id: str, previous_image: str | None = None) -> str | None:
         uploaded_file = request.files.get("image")
         if not uploaded_file or not uploaded_file.filename:
             return previous_image
 
-        if not allowed_file(uploaded_file.filename):
+        extension = allowed_extension(uploaded_file.filename)
+        if extension is None:
             flash("Formato de imagem invlido. Use png, jpg, jpeg, gif ou webp.", "error")
             return previous_image
 
-        filename = secure_filename(uploaded_file.filename)
-        extension = filename.rsplit(".", 1)[1].lower()
-        final_name = f"{character_id}.{extension}"
+        # A fresh name per upload, so a queued unlink of the previous image can
+        # never hit the file just written.
+        final_name = f"{character_id}-{os.urandom(4).hex()}.{extension}"
         destination = app.config["UPLOAD_FOLDER"] / final_name
 
-        uploaded_file.save(destination)
+        with open(destination, "wb", buffering=UPLOAD_CHUNK_SIZE) as out:
+            shutil.copyfileobj(uploaded_file.stream, out, length=UPLOAD_CHUNK_SIZE)
 
         if previous_image and previous_image != f"uploads/{final_name}":
-            old_path = app.config["UPLOAD_FOLDER"] / Path(previous_image).name
-            if old_path.exists():
-                old_path.unlink()
+            _queue_unlink(app.config["UPLOAD_FOLDER"] / Path(previous_image).name)
 
         return f"uploads/{final_name}"
 
     def extract_character_form(existing: Dict[str, Any] | None = None) -> Dict[str, Any]:
-        attributes: Dict[str, int] = {}
-        for key, _label in ATTRIBUTE_FIELDS:
-            raw_value = request.form.get(f"attr_{key}", "")
-            try:
-                attributes[key] = int(raw_value)
-            except ValueError:
-                attributes[key] = 0
-
-        return {
-            "name": request.form.get("name", "").strip(),
-            "race": request.form.get("race", "").strip(),
-            "character_class": request.form.get("character_class", "").strip(),
-            "background": request.form.get("background", "").strip(),
-            "level": request.form.get("level", "1").strip() or "1",
-            "hit_points": request.form.get("hit_points", "").strip(),
-            "armor_class": request.form.get("armor_class", "").strip(),
-            "speed": request.form.get("speed", "").strip(),
-            "attributes": attributes,
-            "proficiencies": request.form.get("proficiencies", ""),
-            "equipment": request.form.get("equipment", ""),
-            "spells": request.form.get("spells", ""),
-            "notes": request.form.get("notes", ""),
-            "image": existing.get("image") if existing else None,
+        form = request.form
+        character: Dict[str, Any] = {key: form.get(key, "").strip() for key in _STRIPPED_FIELDS}
+        character["level"] = character["level"] or "1"
+        character["attributes"] = {
+            key: _to_int(form.get(field)) for key, field in _ATTRIBUTE_FORM_KEYS
         }
+        for key in _TEXT_FIELDS:
+            character[key] = form.get(key, "")
+        character["image"] = existing.get("image") if existing else None
+        return character
 
     @app.route("/")
     def index() -> str:
-        characters = load_characters()
+        # The index file is kept ordered by name, so no sorting is needed here.
+        characters = [
+            {**summary, "id": character_id} for character_id, summary in load_index().items()
+        ]
         return render_template("index.html", characters=characters)
 
     @app.route("/characters/new")
     def new_character() -> str:
-        blank_character = {
-            "name": "",
-            "race": "",
-            "character_class": "",
-            "background": "",
-            "level": "1",
-            "hit_points": "",
-            "armor_class": "",
-            "speed": "",
-            "attributes": {key: 10 for key, _ in ATTRIBUTE_FIELDS},
-            "proficiencies": "",
-            "equipment": "",
-            "spells": "",
-            "notes": "",
-            "image": None,
-        }
         return render_template(
             "form.html",
-            character=blank_character,
+            character=copy.deepcopy(_BLANK_CHARACTER),
             attribute_fields=ATTRIBUTE_FIELDS,
             form_action=url_for("create_character"),
             submit_label="Criar personagem",
@@ -142,7 +380,7 @@ def create_app() -> Flask:
 
     @app.route("/characters", methods=["POST"])
     def create_character() -> Any:
-        character_id = uuid.uuid4().hex
+        character_id = os.urandom(16).hex()
         character = extract_character_form()
 
         if not character["name"]:
@@ -151,9 +389,7 @@ def create_app() -> Flask:
 
         character["image"] = handle_image_upload(character_id)
 
-        save_path = data_dir / f"{character_id}.json"
-        with save_path.open("w", encoding="utf-8") as fp:
-            json.dump(character, fp, ensure_ascii=False, indent=2)
+        store_character(character_id, character)
 
         flash("Personagem criado com sucesso!", "success")
         return redirect(url_for("view_character", character_id=character_id))
@@ -185,9 +421,8 @@ def create_app() -> Flask:
 
         character["image"] = handle_image_upload(character_id, previous_image=existing.get("image"))
 
-        save_path = data_dir / f"{character_id}.json"
-        with save_path.open("w", encoding="utf-8") as fp:
-            json.dump(character, fp, ensure_ascii=False, indent=2)
+        cache.pop(character_id, None)
+        store_character(character_id, character)
 
         flash("Personagem atualizado!", "success")
         return redirect(url_for("view_character", character_id=character_id))
@@ -195,13 +430,10 @@ def create_app() -> Flask:
     @app.route("/characters/<character_id>/delete", methods=["POST"])
     def delete_character(character_id: str) -> Any:
         character = load_character(character_id)
-        path = data_dir / f"{character_id}.json"
-        if path.exists():
-            path.unlink()
+        cache.pop(character_id, None)
+        store_character(character_id, None)
         if character.get("image"):
-            image_path = app.config["UPLOAD_FOLDER"] / Path(character["image"]).name
-            if image_path.exists():
-                image_path.unlink()
+            _queue_unlink(app.config["UPLOAD_FOLDER"] / Path(character["image"]).name)
         flash("Personagem removido.", "info")
         return redirect(url_for("index"))
 
@@ -212,4 +444,4 @@ app = create_app()
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1")